@@ -16,28 +16,14 @@ def convertMatchedDict(matched:dict) -> dict:
         }
 
 def saveHeader2csv(meta):
-    print("offset,type,key,comment")
-    list(map(lambda m:
-            print("{offset},{type},{key},{comment}"
-                .format(**m)),
-            meta)
-        )
+    rows = ["offset,type,key,comment"]
+    rows.extend("{offset},{type},{key},{comment}".format(**m) for m in meta)
+    sys.stdout.write("\n".join(rows) + "\n")
 
 def getHeaders(filename) -> list:
-    fhandler = open(filename)
-    fdata = fhandler.readlines()
-    metadata = []
-    for d in fdata:
-#    sys.stdout.write(d)
-        match = re.match(pattern, d)
-        if match is not None:
-#        print(match.groupdict())
-            metadata.append(
-                    convertMatchedDict(
-                        match.groupdict()
-                        )
-                    )
-    return metadata
+    with open(filename) as fhandler:
+        return [convertMatchedDict(match.groupdict())
+                for d in fhandler if (match := pattern.match(d))]
 def downloadHeaders():
     url = 'https://gist.github.com/iainrosen/6d767384027a3bcf4edc20a2abc7fb73/raw/a2445dc08b73092c4ad66e587c673b1015923fc5/WINHEAD.txt'
     r = requests.get(url, allow_redirects=True)
@@ -13,8 +13,14 @@ NOTE little-endian assumed
 
 import sys
 import os
+import io
 import re
+import mmap
 import struct
+import pickle
+import hashlib
+import functools
+import multiprocessing
 
 import numpy as np
 from astropy.io import fits
@@ -52,6 +58,9 @@ class SPE:
             'l': np.int32,
             'h': np.short,
             'H': np.ushort,
+            'd': np.double,
+            'B': np.ubyte,
+            'L': np.uint32,
             }
 
     #  char
@@ -74,7 +83,7 @@ class SPE:
             }
 
     # headers which are to be ignored
-    SPE_IGNORE = {
+    SPE_IGNORE = (
             'pixel_position',
             'Spare',
             'Comments',
@@ -84,13 +93,26 @@ class SPE:
             'Spec',
             'PImax',
             'FlatField',
-            }
+            )
+    _IGNORE_RE = re.compile('|'.join(map(re.escape, SPE_IGNORE)))
+
+    # header dtype cache, see `headerDtype`
+    _HEADER_DTYPES = {}
+
+    # parsed header defination files are cached here, see `loadHeadersDef`
+    HEADER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'spe2fits')
 
-    # XXX share headerDef between multiple files maybe better ?
-    def __init__(self, filename, headerfile = None):
+    def __init__(self, filename, headerfile = None, headerDef = None):
+        """ filename: .SPE file name or opened file
+        headerfile: header defination file, see `loadHeadersDef`
+        headerDef: already loaded header defination, shared between
+                   files to skip loading it again; overrides headerfile
+        """
         self._filename = filename
 
-        if headerfile is not None:
+        if headerDef is not None:
+            self._headerDef = headerDef
+        elif headerfile is not None:
             self._headerDef = self.loadHeadersDef(headerfile)
         else:
             self._headerDef = self.loadHeadersDef()
@@ -101,12 +123,24 @@ class SPE:
             self._fileObj = filename
             self._filename = os.path.realname(filename.name)
 
+        try:
+            self._mm = mmap.mmap(self._fileObj.fileno(), 0, access = mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError): # no real file behind fileObj
+            self._mm = None
+
         self._fitshdr = self._initFitsHeader()
-        self._spe_header = self.loadSpeHeader(self._fileObj, self._headerDef)
+        self._spe_header, self._header_cards = self.loadSpeHeader(
+                self._mm if self._mm is not None else self._fileObj,
+                self._headerDef)
         self._extractInfo()
 
     def __del__(self):
         # XXX not tested yet
+        if getattr(self, '_mm', None) is not None:
+            try:
+                self._mm.close()
+            except BufferError: # frames returned by loadSpeImg still alive
+                pass
         self._fileObj.close()
 
     @property
@@ -115,6 +149,7 @@ class SPE:
 
     @property
     def speHeader(self):
+        " .SPE header as numpy structured record, see `headerDtype` "
         return self._spe_header
 
     @property
@@ -132,12 +167,12 @@ class SPE:
 
     @property
     def imgSize(self):
-        if not hasattr(self, '_img_size'):
-            self._img_size = self._xdim * self._ydim * struct.calcsize(self._datatype)
         return self._img_size
 
     def loadSpeImg(self, index):
         """ return a list of images' data
+        If the file is memory-mapped, the arrays are read-only views
+        into the map, copy() them before modifying
         """
         from collections.abc import Iterable
         if isinstance(index, Iterable):
@@ -149,51 +184,108 @@ class SPE:
                 print("Warning: invalid image index", index, ". Fetch all available images")
                 index = list(range(self._img_count))
 
+        if index == list(range(self._img_count)):
+            return self.loadAllSpeImgs()
+
         datas = {}
-        fmt = str(self._xdim * self._ydim) + self._datatype
         for i in index:
-            self._fileObj.seek(SPE.SPE_DATA_OFFSET + i * self._img_size)
-            data = self._fileObj.read(self._img_size)
-            datas[i] = np.array(
-                    struct.unpack(fmt, data),
-                    dtype = self._ndtype
-                    ).reshape(self._ydim, self._xdim)
+            datas[i] = self._readFrames(i, 1)[0]
         return datas
 
-    def writeToFits(self, dataArrs, outPrefix = None, clobber = True, output_verify = "exception"):
+    def loadAllSpeImgs(self):
+        """ return all images' data, as views of one contiguous read
+        """
+        frames = self._readFrames(0, self._img_count)
+        return {i: frames[i] for i in range(self._img_count)}
+
+    def iterSpeImgs(self):
+        """ yield (index, image data) of all images one by one
+        Without mmap every image is read into the same buffer, so it is only
+        valid until the next one is yielded, copy() it to keep it
+        """
+        if self._mm is not None:
+            yield from self.loadAllSpeImgs().items()
+            return
+        frame = np.empty((self._ydim, self._xdim), dtype = self._ndtype)
+        self._fileObj.seek(SPE.SPE_DATA_OFFSET)
+        for i in range(self._img_count):
+            if self._fileObj.readinto(frame) != self._img_size:
+                raise ValueError("{}: image {} is truncated".format(self._filename, i))
+            yield i, frame
+
+    def _readFrames(self, start, n):
+        """ read n frames from frame start on
+        return: ndarray shaped (n, ydim, xdim)
+        """
+        offset = SPE.SPE_DATA_OFFSET + start * self._img_size
+        count = n * self._frame_nelems
+        if self._mm is not None:
+            data = np.frombuffer(self._mm, dtype = self._ndtype,
+                    count = count, offset = offset)
+        else:
+            self._fileObj.seek(offset)
+            try:
+                data = np.fromfile(self._fileObj, dtype = self._ndtype, count = count)
+            except io.UnsupportedOperation: # not a real file, e.g. BytesIO
+                data = np.frombuffer(self._fileObj.read(n * self._img_size),
+                        dtype = self._ndtype, count = count)
+        return data.reshape(n, self._ydim, self._xdim)
+
+    def writeToFits(self, dataArrs, outPrefix = None, clobber = True, output_verify = "ignore"):
         """ Save dict of ndarray to fits file
         dataArrs: {index: dataArr} returned by `loadSpeImg`
         """
         if outPrefix is None:
-            matched = re.match('(.*)\.spe.*$', self._filename, flags = re.IGNORECASE)
-            if matched is not None and matched.groups()[0] != '':
-                outPrefix = matched.groups()[0]
-            else:
-                outPrefix = self._filename
+            outPrefix = self._outPrefix()
 
         for index, dataArr in dataArrs.items():
             name = "{}_x{:03}.fits".format(outPrefix, index)
-            hdu = fits.PrimaryHDU(data = dataArr,
+            hdu = fits.PrimaryHDU(data = SPE.toBigEndian(dataArr),
                     header = self._fitshdr,
                     )
-            hdu.writeto(name, output_verify, clobber)
+            hdu.writeto(name, output_verify = output_verify,
+                    overwrite = clobber, checksum = False)
+
+    @staticmethod
+    def toBigEndian(dataArr):
+        " FITS data is big-endian, swap it in one copy so astropy writes it as is "
+        return dataArr.astype(dataArr.dtype.newbyteorder('>'), copy = False)
+
+    def _outPrefix(self):
+        " default output name: SPE filename without extension "
+        matched = re.match('(.*)\.spe.*$', self._filename, flags = re.IGNORECASE)
+        if matched is not None and matched.groups()[0] != '':
+            return matched.groups()[0]
+        return self._filename
+
+    def spe2fits_mef(self, outname = None, clobber = True, output_verify = "ignore"):
+        """ Save all frames in .SPE to one multi-extension FITS
+        Primary HDU holds the header, each frame is an image extension
+        """
+        if outname is None:
+            outname = self._outPrefix() + ".fits"
+        datas = self.loadSpeImg(range(self._img_count))
+        hdul = fits.HDUList(
+                [fits.PrimaryHDU(header = self._fitshdr)] +
+                [fits.ImageHDU(data = SPE.toBigEndian(dataArr)) for dataArr in datas.values()]
+                )
+        hdul.writeto(outname, output_verify = output_verify,
+                overwrite = clobber, checksum = False)
 
     def spe2fits(self, **kwargs):
         """ Shortcut method for saving all frames in .SPE to FITS
         Each FITS contains only one frame
         """
-        for count in range(self._img_count):
+        for count, dataArr in self.iterSpeImgs():
             print(count)
-            datas = self.loadSpeImg(count)
-            self.writeToFits(datas, **kwargs)
+            self.writeToFits({count: dataArr}, **kwargs)
 
     def _initFitsHeader(self):
         fitshdr = fits.header.Header()
         def uglySetHeader(key, val, comment):
-            try:
-                fitshdr[key] = ( val, comment )
-            except:
-                fitshdr[key] = ( str(val.encode()), comment )
+            if not (val.isascii() and val.isprintable()): # FITS only takes printable ASCII
+                val = str(val.encode())
+            fitshdr[key] = ( val, comment )
         # Add additional header
         fitshdr['HEAD']    = ('PVCAM', 'Head model')
 #        fitshdr['SPEFNAME'] = (self._filename, "original SPE filename")
@@ -212,118 +304,166 @@ class SPE:
     def datatype(self, datatype):
         " bind ndtype and datatype "
         self._datatype = datatype
-        self._ndtype = SPE.STRUCT_TO_NUMPY[datatype]
+        # frames are little-endian; on little-endian hosts this is the native
+        # dtype, so the common 'H' and 'f' frames are read without any conversion
+        self._ndtype = np.dtype(SPE.STRUCT_TO_NUMPY[datatype]).newbyteorder('<')
 
     def _extractInfo(self):
         """ Extract information and construct FITS header from .SPE header
         """
-        self._stripIgnore()
-
-        self._img_count = self._spe_header['NumFrames'][0]
-        self._xdim = self._spe_header['xdim'][0]
-        self._ydim = self._spe_header['ydim'][0]
-        self.datatype = SPE.SPE_DATATYPE.get(self._spe_header['datatype'][0], 'f')
-        self._img_size = self._xdim * self._ydim * struct.calcsize(self.datatype)
-
-        for k, v in self._spe_header.items():
-            self._fitshdr[k.upper()] = v # why astropy does not auto upper or ignore case..
+        record = self._spe_header
+        self._img_count = record['NumFrames'].item()
+        self._xdim = record['xdim'].item()
+        self._ydim = record['ydim'].item()
+        self.datatype = SPE.SPE_DATATYPE.get(record['datatype'].item(), 'f')
+        self._frame_nelems = self._xdim * self._ydim
+        self._pixel_nbytes = struct.calcsize('<' + self._datatype) # standard size, 'l' is 4 bytes
+        self._img_size = self._frame_nelems * self._pixel_nbytes
+
+        # python values in field order, sub arrays as lists
+        values = [v.tolist() if isinstance(v, np.ndarray) else v for v in record.item()]
+        cards = []
+        for pos, index, isStr, ignorable, key, comment in self._header_cards:
+            val = values[pos] if index is None else values[pos][index]
+            if isStr: # strip null character
+                val = val.partition(b'\x00')[0].decode('latin-1')
+            if ignorable and val in ('', 0, 0.0): # see SPE_IGNORE
+                continue
+            cards.append((key, val, comment))
+        self._fitshdr.extend(cards)
 
         self.renameHeaderKey('exp_sec', 'EXPOSURE')
         self.renameHeaderKey('ReadoutTime', 'READTIME', 'Experiment readout time in ms')
         self.renameHeaderKey('DetTemperature', 'TEMP')
 
-    def _stripIgnore(self):
-        """ Remove some headers in .SPE file
-        """
-        keys = list(self._spe_header.keys())
-        for key in keys:
-            for toIgnore in SPE.SPE_IGNORE:
-                if toIgnore in key and self._spe_header[key][0] in ('', 0, 0.0):
-                    self._spe_header.pop(key)
-
     def renameHeaderKey(self, oldname, newname, newcomment = None):
-        """ Change FITS header's key name
+        """ Change FITS header's key name, the card keeps its place
         """
-        fitshdr = self._fitshdr
         try:
-            comment = newcomment if newcomment is not None else fitshdr.comments[oldname]
-            fitshdr.insert(3, (newname, fitshdr[oldname], comment), after = True)
-            fitshdr.remove(oldname)
-        except Exception as e:
-            print("Warning:", e)
+            self._fitshdr.rename_keyword(oldname, newname)
+        except KeyError: # not in the header
+            return
+        if newcomment is not None:
+            self._fitshdr.comments[newname] = newcomment
 
     # Some header to be added:  ROIinfo, type,
     # TODO save header defination to python
     @staticmethod
     def loadHeadersDef(headerfile = "WINHEAD.TXT"):
         """ load/parse header defination file
+        The parsed result is pickled to HEADER_CACHE_DIR, keyed by the md5
+        of headerfile, and reused as long as headerfile is unchanged
         """
-        import extractHeaderDesc as H
         if not os.path.exists(headerfile):
+            import extractHeaderDesc as H
             print("Downloading header file required for conversion")
             H.downloadHeaders()
         print("Using header: "+headerfile)
+        with open(headerfile, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        cachefile = os.path.join(SPE.HEADER_CACHE_DIR, 'headerdef-{}.pkl'.format(digest))
+        try:
+            with open(cachefile, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        import extractHeaderDesc as H
         headers = H.getHeaders(headerfile)
+        try: # the cache is optional, ignore unwritable dirs
+            os.makedirs(SPE.HEADER_CACHE_DIR, exist_ok = True)
+            tmpfile = "{}.{}".format(cachefile, os.getpid())
+            with open(tmpfile, 'wb') as f:
+                pickle.dump(headers, f)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            pass
         return headers
 
     @staticmethod
     def loadSpeHeader(fileObj, headerDef):
-        """ load and save .SPE file header
-        fileObj:  file handler(opened file, can be read())
+        """ load .SPE file header
+        fileObj:  file handler(opened file, can be read()) or mmap of the file
         headerDef: [{}], keys: 'offset', 'type', 'key', 'comment'
+        return: (record, cards), see `headerDtype`
         """
-        headerDict = {}
-        fileObj.seek(0)
-        headerData = fileObj.read(SPE.SPE_DATA_OFFSET)
-        for header in headerDef:
-            #print(header)
-            key = header['key']
-            offset = header['offset']
-            type_ = header['type']
-            comment = header['comment']
-            fmt, counts, size, key = SPE.parseFormat(type_, key)
-            SPE.addToHeader(headerDict, headerData, key,
-                    offset = offset,
-                    fmt = fmt,
-                    counts = counts,
-                    length = size,
-                    comment = comment,
-                    )
-        return headerDict
+        if isinstance(fileObj, mmap.mmap):
+            headerData = fileObj # frombuffer reads the map in place
+        else:
+            fileObj.seek(0)
+            headerData = fileObj.read(SPE.SPE_DATA_OFFSET)
+        dtype, cards = SPE.headerDtype(headerDef)
+        # copy, so the record does not pin the file's mmap
+        record = np.frombuffer(headerData, dtype = dtype, count = 1)[0].copy()
+        return record, cards
+
+    @staticmethod
+    def headerDtype(headerDef):
+        """ build numpy structured dtype of .SPE header, and FITS cards template
+        headerDef: [{}], keys: 'offset', 'type', 'key', 'comment'
+        return: (dtype, [(pos, index, isStr, ignorable, 'KEY', 'comment')])
+            pos: field position in the record
+            index: sub array index for a[b] and a[b][c] (saved as KEY_<index>),
+                   None otherwise
+            ignorable: key matches SPE_IGNORE, dropped if empty
+        result is cached, so it is built once per headerDef
+        """
+        cacheKey = tuple((h['type'], h['key'], h['offset']) for h in headerDef)
+        if cacheKey not in SPE._HEADER_DTYPES:
+            # some keys are defined twice (x and y calibration), the last one wins
+            fields = {}
+            for header in headerDef:
+                fmt, key = SPE.parseFormat(header['type'], header['key'])
+                fields[key] = (fmt, header['offset'], header['comment'])
+            dtype = np.dtype({
+                'names':   list(fields.keys()),
+                'formats': [f[0] for f in fields.values()],
+                'offsets': [f[1] for f in fields.values()],
+                'itemsize': SPE.SPE_DATA_OFFSET,
+                })
+            cards = []
+            for pos, (key, f) in enumerate(fields.items()):
+                fieldType = dtype.fields[key][0]
+                isStr = fieldType.base.kind == 'S'
+                ignorable = SPE._IGNORE_RE.search(key) is not None
+                if fieldType.shape:
+                    for i in range(fieldType.shape[0]):
+                        newkey = "{key}_{index}".format(
+                                key = key,
+                                index = i,
+                                )
+                        cards.append((pos, i, isStr, ignorable, newkey.upper(), f[2]))
+                else:
+                    cards.append((pos, None, isStr, ignorable, key.upper(), f[2]))
+            SPE._HEADER_DTYPES[cacheKey] = (dtype, cards)
+        return SPE._HEADER_DTYPES[cacheKey]
 
     @staticmethod
     def parseFormat(type_, key):
-        """ parse format with type and key
-        convert a[b] to b'fmt'
-        convert a[b][c] to b * cs if type is char
-        return: ('fmt',   'counts',  'length', 'key')
-        #0 char a[b][c] -> ('<c>s',  <b>,   <c>, 'a')
-        #1 char a[b]    -> ('<b>s',  1,     0,   'a')
-        #2 type a[b]    -> ('<b><t>',1,     0,   'a')
-                 ( unpack will get tuple length > 1 )
-        #3 type a       -> ('<t>',   1,     0,   'a')
-                default is #3
+        """ parse numpy (little-endian) format with type and key
+        return: ('format', 'key')
+        #0 char a[b][c] -> (('S<c>', (<b>,)), 'a')
+        #1 char a[b]    -> ('S<b>',           'a')
+        #2 char a       -> ('S1',             'a')
+        #3 type a[b]    -> ((<t>, (<b>,)),    'a')
+        #4 type a       -> (<t>,              'a')
+                default is #4
         """
-        counts = 1
-        length = 0 # only not zero for a[b][c] (length will be c)
         got = key.partition('[') # a[b]:('a','[','b]')  a[b][c]:('a','[','b][c]')
         realKey, rest = got[0], got[2]
         fmt = SPE.SPE_TYPE_FMT.get(type_, 'c')
-        if rest != '' and fmt == 'c': # #0 or #1
-            fmt = 's'
-            newgot = rest.partition(']') # ('b',']','') or ('b',']','[c]')
-            length = SPE.fetchLength(newgot[0]) # 'b'
-            if newgot[2] != '': # '[c]' #0
-                counts = length # 'counts' is 'b'
+        newgot = rest.partition(']') # ('b',']','') or ('b',']','[c]')
+        if fmt == 'c':
+            if newgot[2] != '': # #0
                 c_length = SPE.fetchLength(newgot[2][1:-1]) # '[c]' -> c
-                fmt = str(c_length) + fmt # <c>s
-                length = c_length # 'length' is 'c'
-            else: # '' #1
-                fmt = str(length) + fmt # <b>s
-                length = 0
-        elif rest != '': # #2
-            fmt = rest.partition(']')[0] + fmt # 'b''fmt'
-        return fmt, counts, length, realKey
+                return ('S{}'.format(c_length), (SPE.fetchLength(newgot[0]),)), realKey
+            if rest != '': # #1
+                return 'S{}'.format(SPE.fetchLength(newgot[0])), realKey
+            return 'S1', realKey # #2
+        ndtype = np.dtype(SPE.STRUCT_TO_NUMPY[fmt]).newbyteorder('<')
+        if rest != '': # #3
+            return (ndtype, (SPE.fetchLength(newgot[0]),)), realKey
+        return ndtype, realKey # #4
 
     @staticmethod
     def fetchLength(lenStr):
@@ -335,57 +475,21 @@ class SPE:
             length = 1
         return length
 
-    @staticmethod
-    def addToHeader(headerDict, headerData, key,
-            offset = 0, fmt = 'c', counts = 1, length = 0, comment = ''):
-        """ add new extracted data to header
-        headerDict: dict with header info which is to be updated
-        headerData: data of header
-        key: key name to be parsed and added
-        offset: read offset
-        counts: key will be parsed to (counts) sub key
-        length: for counts > 1, length gives each count's size
-        comment: comment/description of the key
-        """
-        if counts == 1:
-            val = struct.unpack_from(fmt, headerData, offset=offset)
-            if len(val) > 1:
-                for i in range(len(val)):
-                    newkey = "{key}_{index}".format(
-                            key = key,
-                            index = i,
-                            )
-                    headerDict[newkey] = (SPE.checkVal(val[i], fmt), comment)
-            else:
-                headerDict[key] = (SPE.checkVal(val[0], fmt), comment)
-        else:
-            for i in range(counts):
-                val = struct.unpack_from(fmt, headerData, offset = i * length + offset)
-                newkey = "{key}_{index}".format(
-                        key = key,
-                        index = i,
-                        )
-                headerDict[newkey] = (SPE.checkVal(val[0], fmt), comment)
-
-    @staticmethod
-    def checkVal(val, fmt):
-        """ modify val with fmt's info
-        we will strip null character
-        """
-        if 's' in fmt:
-            return val.decode().partition('\x00')[0]
-        if 'c' in fmt and ord(val) == 0:
-            return ''
-        return val
+def convertSpe(filename, headerDef = None):
+    """ Convert one .SPE file to FITS, run in a worker process by --all
+    """
+    print("Now converting: "+filename)
+    speHandler = SPE(filename, headerDef = headerDef)
+    speHandler.spe2fits()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support() # for the frozen release executables
     filename = sys.argv[1]
     if filename=="--all":
-        for i in os.listdir("."):
-            if i.endswith(".SPE"):
-                print("Now converting: "+i)
-                speHandler = SPE(i)
-                speHandler.spe2fits()
+        headerDef = SPE.loadHeadersDef()
+        files = [i for i in os.listdir(".") if i.endswith(".SPE")]
+        with multiprocessing.Pool() as pool:
+            pool.map(functools.partial(convertSpe, headerDef = headerDef), files)
     else:
         speHandler = SPE(filename)
         speHandler.spe2fits()